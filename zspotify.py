@@ -7,22 +7,36 @@ It's like youtube-dl, but for Spotify.
 
 __version__ = "1.9.4"
 
+import contextlib
+import errno
+import functools
+import cProfile
+import hashlib
 import json
+import math
 import os
 import os.path
 import platform
+import pstats
 import re
+import subprocess
 import sys
 import time
 import shutil
+import threading
 from getpass import getpass
 import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
+import mutagen
+from mutagen.oggvorbis import OggVorbis
 import requests
 from librespot.audio.decoders import AudioQuality, VorbisOnlyAudioQuality
+from librespot.audio.storage import ChannelManager
 from librespot.core import Session
 from librespot.metadata import TrackId, EpisodeId
 from pydub import AudioSegment
+from pydub.exceptions import CouldntEncodeError
 from tqdm import tqdm
 from appdirs import user_config_dir
 
@@ -30,12 +44,21 @@ from appdirs import user_config_dir
 USE_MUTAGEN = True 
 
 if USE_MUTAGEN:
-    from mutagen.id3 import ID3, TPE1, TIT2, TRCK, TALB, APIC, TPE2, TDRC, TDOR, TPOS, COMM, TCON
+    from mutagen.id3 import ID3, TPE1, TIT2, TRCK, TALB, APIC, TPE2, TDRC, TDOR, TPOS, COMM, TCON, TXXX
 else:
     import music_tag
 
 
 SESSION: Session = None
+# machine readable output (--plan --json, PROGRESS=json events) is written here, the rest of the messages go to
+# stderr when it is requested
+OUTPUT = sys.stdout
+SEARCH_CACHE = {}
+COVER_CACHE = {}
+PREFETCH = {}
+PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+# Only the first PREFETCH_RESULTS albums, playlists (of a single listing page) and artists of a search are prefetched
+PREFETCH_RESULTS = 5
 sanitize = ["\\", "/", ":", "*", "?", "'", "<", ">", '"']
 
 
@@ -58,11 +81,89 @@ CHUNK_SIZE = 50000
 
 CREDENTIALS = os.path.join(CONFIG_DIR, "credentials.json")
 
+# Set MULTI_NODE=y when several zspotify containers download into the same ROOT_PATH. Each track is then claimed
+# with a lease file in ROOT_PATH/.leases that is renewed while the track downloads and expires LEASE_TIME seconds
+# after its worker stopped renewing it, and the archive is only written while holding a lock.
+MULTI_NODE = os.getenv('MULTI_NODE') == "y"
+WORKER_ID = os.getenv('WORKER_ID') or f"{platform.node()}-{os.getpid()}"
+LEASE_TIME = 300
+LEASES = {}
+CLAIMED_ELSEWHERE = []
+
+# ReplayGain 2.0 reference loudness, track gain is REPLAYGAIN_REFERENCE - integrated loudness of the track
+REPLAYGAIN_REFERENCE = -18.0
+ALBUM_LOUDNESS = None
+PCM_FORMATS = {1: "u8", 2: "s16le", 3: "s24le", 4: "s32le"}
+
+# --profile samples the main thread's stack every PROFILE_INTERVAL seconds, tagged with the stage and track id
+PROFILE_INTERVAL = 0.01
+PROFILE_STAGE = ["idle", ""]
+PROFILE_HOT_SPOTS = r"download_track|download_episode|convert_audio_format|set_audio_tags|set_album_gain|get_|search"
+
 LIMIT = 50 
 
 requests.adapters.DEFAULT_RETRIES = 10
 REINTENT_DOWNLOAD = 30
 
+# Before a download starts it reserves its stream size (plus CONVERSION_HEADROOM times that for the converted copy)
+# and waits while the reservations would exceed MAX_IN_FLIGHT_BYTES or leave less than MIN_FREE_SPACE bytes free
+# on the download volume.
+MIN_FREE_SPACE = 1024 * 1024 * 1024
+MAX_IN_FLIGHT_BYTES = 1024 * 1024 * 1024
+CONVERSION_HEADROOM = 1.0
+IN_FLIGHT_BYTES = 0
+RESERVATIONS = {}
+BUDGET = threading.Condition()
+
+# Set STAGING_PATH to a fast local folder (or tmpfs) to download, convert and tag tracks there. Finished tracks are
+# moved to ROOT_PATH, and added to the archive, in batches of STAGING_BATCH_SIZE and at the end of every album.
+STAGING_PATH = os.getenv('STAGING_PATH') or ""
+STAGING_BATCH_SIZE = 20
+STAGED = []
+
+# Tracks whose audio file id or ISRC matches a file we already have are not downloaded again. DEDUP_MODE "copy"
+# copies the existing file and tags it for the new track, "link" hard links it as is, "off" always downloads.
+DEDUP_MODE = os.getenv('DEDUP_MODE') or "copy"
+RECORDINGS = None
+
+RETAG_WORKERS = 8
+
+# --upgrade reads the bitrate of every track with UPGRADE_WORKERS threads, rounds it to the nearest of QUALITY_TIERS
+# (kbps) and downloads again the tracks whose tier is below the current session's
+UPGRADE_WORKERS = 8
+QUALITY_TIERS = (96, 160, 320)
+
+# Set AUTOTUNE=y to let zspotify adjust the read size, the wait between tracks and the number of parallel segments
+# from the observed throughput, API latency and errors, within the bounds below. Every change is logged to
+# CONFIG_DIR/autotune.log with the reason for it.
+AUTOTUNE = os.getenv('AUTOTUNE') == "y"
+AUTOTUNE_WINDOW = 20
+AUTOTUNE_CHUNK_SIZE = (16 * 1024, 1024 * 1024)
+AUTOTUNE_WAIT = (0, 60)
+AUTOTUNE_SEGMENTS = (1, 16)
+AUTOTUNE_LATENCY = 1.0
+API_CALLS = []
+TRACK_RATES = []
+STREAM_FAILURES = []
+TUNED = {}
+TUNE_LOCK = threading.Lock()
+
+# Progress of the current job is drawn on one line, redrawn at most every PROGRESS_INTERVAL seconds. When stdout is
+# not a terminal (docker logs, pipes) or PROGRESS=json, one JSON object per line is printed instead for every job,
+# item-started, item-done, skipped, failed and retry event.
+PROGRESS_MODE = os.getenv('PROGRESS') or ("bar" if sys.stdout.isatty() else "json")
+PROGRESS_INTERVAL = 0.5
+PROGRESS = {'kind': None, 'name': "", 'total': 0, 'done': 0, 'skipped': 0, 'failed': 0, 'bytes': 0,
+            'start': 0.0, 'item': "", 'drawn': 0.0}
+
+# Streams of at least SEGMENTED_MIN_SIZE bytes (long podcast episodes) are fetched SEGMENT_WORKERS chunks at a time
+SEGMENTED_MIN_SIZE = 32 * 1024 * 1024
+SEGMENT_WORKERS = 8
+
+# How many seconds a file's duration may differ from Spotify's before --verify reports it as broken
+VERIFY_TOLERANCE = 2
+AUDIO_EXTENSIONS = (".mp3", ".ogg", ".wav")
+
 # miscellaneous functions for general use
 
 
@@ -76,9 +177,14 @@ def clear():
 
 def wait(seconds: int = 3):
     """ Pause for a set number of seconds """
-    for i in range(seconds)[::-1]:
-        print("\rWait for %d second(s)..." % (i + 1), end="")
-        time.sleep(1)
+    PROGRESS['item'] = f"waiting {seconds}s"
+    render_progress(force=True)
+    time.sleep(seconds)
+
+
+def is_existing_file(filename):
+    """ Returns True if filename exists and is not empty """
+    return os.path.isfile(filename) and os.path.getsize(filename) > 0
 
 
 def sanitize_data(value):
@@ -97,6 +203,106 @@ def split_input(selection):
         return [i for i in selection.strip().split(" ")]
 
 
+def prefetch(function, *args):
+    """ Starts function(*args) in the background so a later prefetched() call gets its result without waiting """
+    key = (function.__name__,) + args[1:]
+    if key not in PREFETCH:
+        PREFETCH[key] = PREFETCH_EXECUTOR.submit(function, *args)
+
+
+def prefetched(function, *args):
+    """ Returns the result of a prefetch, the first argument (the access token) is not part of the key """
+    future = PREFETCH.pop((function.__name__,) + args[1:], None)
+    if future is not None:
+        try:
+            return future.result()
+        except Exception:
+            pass
+    return function(*args)
+
+
+def cancel_prefetch(keep=()):
+    """ Drops the prefetches nobody asked for, except those of the ids in keep """
+    for key in list(PREFETCH):
+        if key[1] not in keep:
+            PREFETCH.pop(key).cancel()
+
+
+def emit_event(event, **fields):
+    """ Prints a progress event as a JSON line when PROGRESS_MODE is json """
+    if PROGRESS_MODE == "json":
+        print(json.dumps({'event': event, 'time': round(time.time(), 3), **fields}), file=OUTPUT, flush=True)
+
+
+def start_job(kind, name, total):
+    """ Starts counting the progress of a job (album, playlist, show, ...) of total items """
+    end_job()
+    PROGRESS.update(kind=kind, name=name, total=total, done=0, skipped=0, failed=0, bytes=0, start=time.time(),
+                    item="", drawn=0.0)
+    emit_event("job", kind=kind, name=name, total=total)
+    render_progress(force=True)
+
+
+def end_job():
+    """ Reports the totals of the current job """
+    if PROGRESS['kind'] is None:
+        return
+    emit_event("job-done", kind=PROGRESS['kind'], name=PROGRESS['name'], done=PROGRESS['done'],
+               skipped=PROGRESS['skipped'], failed=PROGRESS['failed'], bytes=PROGRESS['bytes'],
+               seconds=round(time.time() - PROGRESS['start'], 1))
+    PROGRESS['item'] = ""
+    render_progress(force=True)
+    if PROGRESS_MODE != "json":
+        print()
+    PROGRESS['kind'] = None
+
+
+def item_started(item_id, name):
+    """ Reports that a track or episode started downloading """
+    if PROGRESS['kind'] is None:
+        start_job("items", "", 0)
+    PROGRESS['item'] = name
+    emit_event("item-started", id=item_id, name=name)
+    render_progress(force=True)
+
+
+def item_progress(size):
+    """ Adds size downloaded bytes to the job, redrawing at most every PROGRESS_INTERVAL seconds """
+    PROGRESS['bytes'] += size
+    render_progress()
+
+
+def item_finished(event, item_id, name, reason=""):
+    """ Reports an item, event is one of item-done, skipped or failed, or retry when the item is tried again
+    (retries are not counted, the item reports again once it finishes) """
+    if event != "retry":
+        PROGRESS[{'item-done': 'done', 'skipped': 'skipped', 'failed': 'failed'}[event]] += 1
+    if PROGRESS_MODE == "json":
+        emit_event(event, id=item_id, name=name, **({'reason': reason} if reason else {}))
+    elif event != "item-done":
+        print(f"\r###   {event.upper()}: {name} ({reason})   ###".ljust(shutil.get_terminal_size().columns - 1))
+    PROGRESS['item'] = ""
+    render_progress(force=True)
+
+
+def render_progress(force=False):
+    """ Redraws the progress line of the current job """
+    now = time.time()
+    if PROGRESS_MODE == "json" or (not force and now - PROGRESS['drawn'] < PROGRESS_INTERVAL):
+        return
+    PROGRESS['drawn'] = now
+    size = tqdm.format_sizeof(PROGRESS['bytes'], 'B', 1024)
+    rate = tqdm.format_sizeof(PROGRESS['bytes'] / max(now - PROGRESS['start'], 1e-3), 'B/s', 1024)
+    line = f"{PROGRESS['done'] + PROGRESS['skipped'] + PROGRESS['failed']}/{PROGRESS['total'] or '?'} " \
+           f"({PROGRESS['skipped']} skipped, {PROGRESS['failed']} failed) {size} {rate}"
+    if PROGRESS['name']:
+        line = f"{PROGRESS['name']}: {line}"
+    if PROGRESS['item']:
+        line += f" | {PROGRESS['item']}"
+    width = shutil.get_terminal_size().columns - 1
+    print("\r" + line[:width].ljust(width), end="", flush=True)
+
+
 def splash():
     """ Displays splash screen """
     print("""
@@ -109,6 +315,64 @@ def splash():
     print(f"version: {__version__}")
 
 
+def set_stage(stage, track_id_str=""):
+    """ Tells the --profile sampler what the main thread is working on """
+    PROFILE_STAGE[:] = [stage, track_id_str]
+
+
+def idle_after(function):
+    """ Sets the --profile stage back to idle whenever function returns, skips or raises """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            set_stage("idle")
+    return wrapper
+
+
+def sample_stacks(thread_id, samples, stop):
+    """ Counts the stacks of thread_id in collapsed stack format until stop is set """
+    while not stop.wait(PROFILE_INTERVAL):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+            frame = frame.f_back
+        key = ";".join([f"stage:{PROFILE_STAGE[0]}", f"track:{PROFILE_STAGE[1] or '-'}"] + stack[::-1])
+        samples[key] = samples.get(key, 0) + 1
+
+
+def run_profiled(function):
+    """ Runs function under cProfile and the stack sampler, then writes the pstats and collapsed stacks to
+    CONFIG_DIR and prints the hot spots """
+    profiler = cProfile.Profile()
+    samples = {}
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_stacks, args=(threading.get_ident(), samples, stop), daemon=True)
+    sampler.start()
+    profiler.enable()
+    try:
+        function()
+    finally:
+        profiler.disable()
+        stop.set()
+        sampler.join()
+
+        os.makedirs(CONFIG_DIR, exist_ok=True)
+        profile_path = os.path.join(CONFIG_DIR, "profile-" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+        profiler.dump_stats(profile_path + ".pstats")
+        with open(profile_path + ".collapsed", 'w', encoding='utf-8') as f:
+            for stack, count in samples.items():
+                f.write(f"{stack} {count}\n")
+
+        print("\n###   HOT SPOTS   ###")
+        stats = pstats.Stats(profiler)
+        stats.sort_stats("cumulative").print_stats(PROFILE_HOT_SPOTS, 20)
+        stats.sort_stats("tottime").print_stats(10)
+        print(f"###   PROFILE SAVED TO {profile_path}.pstats AND .collapsed   ###")
+
+
 # two mains functions for logging in and doing client stuff
 def login():
     """ Authenticates with Spotify and saves credentials to a file """
@@ -157,14 +421,26 @@ def client():
                 download_playlist_by_id(sys.argv[2], sys.argv[3])
             else:
                 print("With the flag playlist_id you must pass the playlist_id and the name of the folder where you will have the songs. Usually these name is the name of the playlist itself.")
+        elif sys.argv[1] == "-pl" or sys.argv[1] == "--plan":
+            if len(sys.argv) > 2:
+                plan_download(sys.argv[2], "--json" in sys.argv)
+            else:
+                print("With the flag plan you must pass the url to plan (or -ls for your liked songs).")
+        elif sys.argv[1] == "-rt" or sys.argv[1] == "--retag":
+            retag_library()
+        elif sys.argv[1] == "-up" or sys.argv[1] == "--upgrade":
+            upgrade_library()
+        elif sys.argv[1] == "-v" or sys.argv[1] == "--verify":
+            verify_library(repair="--no-repair" not in sys.argv)
         elif sys.argv[1] == "-ls" or sys.argv[1] == "--liked-songs":
-            for song in get_saved_tracks(token_for_saved):
+            songs = get_saved_tracks(token_for_saved)
+            start_job("liked songs", "Liked Songs", len(songs))
+            for song in songs:
                 if not song['track']['name']:
-                    print(
-                        "###   SKIPPING:  SONG DOES NOT EXISTS ON SPOTIFY ANYMORE   ###")
+                    item_finished("skipped", song['track']['id'], song['track']['id'], "song does not exist on spotify anymore")
                 else:
                     download_track(song['track']['id'], "Liked Songs/")
-                print("\n")
+            end_job()
         else:
             track_id_str, album_id_str, playlist_id_str, episode_id_str, show_id_str, artist_id_str = regex_input_for_urls(
                 sys.argv[1])
@@ -178,15 +454,19 @@ def client():
             elif playlist_id_str is not None:
                 playlist_songs = get_playlist_songs(token, playlist_id_str)
                 name, creator = get_playlist_info(token, playlist_id_str)
+                start_job("playlist", name, len(playlist_songs))
                 for song in playlist_songs:
                     download_track(song['track']['id'],
                                    sanitize_data(name) + "/")
-                    print("\n")
+                end_job()
             elif episode_id_str is not None:
                 download_episode(episode_id_str)
             elif show_id_str is not None:
-                for episode in get_show_episodes(token, show_id_str):
+                episodes = get_show_episodes(token, show_id_str)
+                start_job("show", get_show_name(token, show_id_str), len(episodes))
+                for episode in episodes:
                     download_episode(episode)
+                end_job()
 
     else:
         search_text = input("Enter search or URL: ")
@@ -203,19 +483,24 @@ def client():
         elif playlist_id_str is not None:
             playlist_songs = get_playlist_songs(token, playlist_id_str)
             name, creator = get_playlist_info(token, playlist_id_str)
+            start_job("playlist", name, len(playlist_songs))
             for song in playlist_songs:
                 download_track(song['track']['id'],
                                sanitize_data(name) + "/")
-                print("\n")
+            end_job()
         elif episode_id_str is not None:
             download_episode(episode_id_str)
         elif show_id_str is not None:
-            for episode in get_show_episodes(token, show_id_str):
+            episodes = get_show_episodes(token, show_id_str)
+            start_job("show", get_show_name(token, show_id_str), len(episodes))
+            for episode in episodes:
                 download_episode(episode)
+            end_job()
         else:
             try:
                 search(search_text)
             except:
+                cancel_prefetch()
                 client()
             client()
 
@@ -312,30 +597,34 @@ def regex_input_for_urls(search_input):
 
 def get_episode_info(episode_id_str):
     token = SESSION.tokens().get("user-read-email")
-    info = json.loads(requests.get("https://api.spotify.com/v1/episodes/" +
+    info = json.loads(api_get("https://api.spotify.com/v1/episodes/" +
                                    episode_id_str, headers={"Authorization": "Bearer %s" % token}).text)
 
     if "error" in info:
-        return None, None
+        return None, None, None
     else:
         # print(info['images'][0]['url'])
-        return sanitize_data(info["show"]["name"]), sanitize_data(info["name"])
+        return sanitize_data(info["show"]["name"]), sanitize_data(info["name"]), info["duration_ms"]
 
 
 def get_show_episodes(access_token, show_id_str):
     """ returns episodes of a show """
+    return [episode["id"] for episode in get_show_episode_items(access_token, show_id_str)]
+
+
+def get_show_episode_items(access_token, show_id_str):
+    """ returns the episode objects listed for a show """
     episodes = []
     offset = 0
     limit = 50
 
     while True:
         headers = {'Authorization': f'Bearer {access_token}'}
-        params = {'limit': limit, 'offset': offset}
-        resp = requests.get(
+        params = {'limit': limit, 'offset': offset, 'market': 'from_token'}
+        resp = api_get(
             f'https://api.spotify.com/v1/shows/{show_id_str}/episodes', headers=headers, params=params).json()
         offset += limit
-        for episode in resp["items"]:
-            episodes.append(episode["id"])
+        episodes.extend(resp["items"])
 
         if len(resp['items']) < limit:
             break
@@ -343,53 +632,94 @@ def get_show_episodes(access_token, show_id_str):
     return episodes
 
 
-def download_episode(episode_id_str):
-    global ROOT_PODCAST_PATH, MUSIC_FORMAT
+def get_show_name(access_token, show_id_str):
+    """ Returns show name """
+    headers = {'Authorization': f'Bearer {access_token}'}
+    resp = api_get(
+        f'https://api.spotify.com/v1/shows/{show_id_str}?market=from_token', headers=headers).json()
+    return sanitize_data(resp['name'])
+
 
-    podcast_name, episode_name = get_episode_info(episode_id_str)
+def get_episode_filename(podcast_name, episode_name):
+    """ Returns the path an episode is saved to """
+    return os.path.join(ROOT_PODCAST_PATH, podcast_name, podcast_name + " - " + episode_name + ".wav")
+
+
+@idle_after
+def download_episode(episode_id_str, replace_file=""):
+    """ Downloads an episode. With replace_file, the episode is downloaded again and atomically replaces that file """
+    global ROOT_PODCAST_PATH, MUSIC_FORMAT
 
-    extra_paths = podcast_name + "/"
+    set_stage("metadata", episode_id_str)
+    podcast_name, episode_name, duration_ms = get_episode_info(episode_id_str)
 
     if podcast_name is None:
-        print("###   SKIPPING: (EPISODE NOT FOUND)   ###")
+        item_finished("skipped", episode_id_str, episode_id_str, "episode not found")
+    elif is_existing_file(get_episode_filename(podcast_name, episode_name)) and SKIP_EXISTING_FILES and not replace_file:
+        item_started(episode_id_str, episode_name)
+        item_finished("skipped", episode_id_str, episode_name, "episode already exists")
     else:
+        extra_paths = podcast_name + "/"
         filename = podcast_name + " - " + episode_name
 
+        set_stage("download", episode_id_str)
+        item_started(episode_id_str, filename)
         episode_id = EpisodeId.from_base62(episode_id_str)
-        stream = SESSION.content_feeder().load(
-            episode_id, VorbisOnlyAudioQuality(QUALITY), False, None)
         # print("###  DOWNLOADING '" + podcast_name + " - " +
         #      episode_name + "' - THIS MAY TAKE A WHILE ###")
 
         #if not os.path.isdir(ROOT_PODCAST_PATH + extra_paths):
         os.makedirs(ROOT_PODCAST_PATH + extra_paths,exist_ok=True)
 
-        total_size = stream.input_stream.size
-        data_left = total_size
-        downloaded = 0
-        _CHUNK_SIZE = CHUNK_SIZE
-        fail = 0
-
-        with open(ROOT_PODCAST_PATH + extra_paths + filename + ".wav", 'wb') as file, tqdm(
-                desc=filename,
-                total=total_size,
-                unit='B',
-                unit_scale=True,
-                unit_divisor=1024
-        ) as bar:
-            while downloaded <= total_size:
-                data = stream.input_stream.stream().read(_CHUNK_SIZE)
-                downloaded += len(data)
-                bar.update(file.write(data))
-                if (total_size - downloaded) < _CHUNK_SIZE:
-                    _CHUNK_SIZE = total_size - downloaded
-                #print(f"[{total_size}][{_CHUNK_SIZE}] [{len(data)}] [{total_size - downloaded}] [{downloaded}]")
-                if len(data) == 0 : 
-                    fail += 1
-                if fail > REINTENT_DOWNLOAD:
-                    break
+        # the episode is written next to its final name and only moved into place once complete, so a failed
+        # download never leaves a file that SKIP_EXISTING_FILES would keep forever
+        episode_filename = replace_file or get_episode_filename(podcast_name, episode_name)
+        try:
+            stream = SESSION.content_feeder().load(
+                episode_id, VorbisOnlyAudioQuality(QUALITY), False, None)
+
+            total_size = stream.input_stream.size
+            downloaded = 0
+            _CHUNK_SIZE = get_tuned('chunk_size')
+            fail = 0
+            start = time.time()
+
+            reserve_bytes(episode_id_str, total_size, ROOT_PODCAST_PATH)
+            try:
+                with open(episode_filename + ".part", 'wb') as file:
+                    if total_size >= SEGMENTED_MIN_SIZE:
+                        download_segmented(stream, file)
+                    else:
+                        while downloaded <= total_size:
+                            data = stream.input_stream.stream().read(_CHUNK_SIZE)
+                            downloaded += len(data)
+                            item_progress(file.write(data))
+                            if (total_size - downloaded) < _CHUNK_SIZE:
+                                _CHUNK_SIZE = total_size - downloaded
+                            #print(f"[{total_size}][{_CHUNK_SIZE}] [{len(data)}] [{total_size - downloaded}] [{downloaded}]")
+                            if len(data) == 0 : 
+                                fail += 1
+                            if fail > REINTENT_DOWNLOAD:
+                                break
+                        # the position includes the header librespot skipped, a complete stream ends at its size
+                        if stream.input_stream.stream().pos() < total_size:
+                            raise IOError(f"stream ended after {stream.input_stream.stream().pos()} of {total_size} bytes")
+            finally:
+                release_bytes(episode_id_str)
+            os.replace(episode_filename + ".part", episode_filename)
+        except Exception as e:
+            observe_stream_failure()
+            if os.path.exists(episode_filename + ".part"):
+                os.remove(episode_filename + ".part")
+            item_finished("failed", episode_id_str, filename, f"download error: {e}")
+            set_stage("idle")
+            return
+        observe_track(total_size, time.time() - start)
+
+        update_library_index(episode_filename, type='episode', id=episode_id_str, duration_ms=duration_ms)
+        item_finished("item-done", episode_id_str, filename)
+        set_stage("idle")
 
-                
         #file.write(stream.input_stream.stream().read())
         # convert_audio_format(ROOT_PODCAST_PATH +
         #                     extra_paths + filename + ".wav")
@@ -397,24 +727,206 @@ def download_episode(episode_id_str):
         # related functions that do stuff with the spotify API
 
 
+def api_get(url, params=None, **kwargs):
+    """ GETs a Spotify Web API url, recording its latency and status for the autotuner and waiting out 429s """
+    for attempt in range(5):
+        start = time.time()
+        resp = requests.get(url, params, **kwargs)
+        observe_api_call(time.time() - start, resp.status_code)
+        if resp.status_code != 429:
+            break
+        time.sleep(int(resp.headers.get('Retry-After', 1)) + 1)
+    return resp
+
+
+def observe_api_call(latency, status_code):
+    """ Records an API call, tuning after every AUTOTUNE_WINDOW calls """
+    API_CALLS.append((latency, status_code))
+    if status_code == 429 or len(API_CALLS) >= AUTOTUNE_WINDOW:
+        autotune()
+
+
+def observe_track(size, seconds):
+    """ Records the throughput of a downloaded stream """
+    if seconds > 0:
+        TRACK_RATES.append(size / seconds)
+    autotune()
+
+
+def observe_stream_failure():
+    """ Records a stream that failed to load or download """
+    STREAM_FAILURES.append(time.time())
+    autotune()
+
+
+def get_tuned(setting):
+    """ Returns the current value of chunk_size, wait or segments """
+    if not TUNED:
+        TUNED.update(chunk_size=CHUNK_SIZE, wait=ANTI_BAN_WAIT_TIME, segments=SEGMENT_WORKERS)
+    return TUNED[setting]
+
+
+def set_tuned(setting, value, bounds, reason):
+    """ Changes a tuned setting within bounds and logs why """
+    value = int(min(max(value, bounds[0]), bounds[1]))
+    if value == get_tuned(setting):
+        return
+    line = f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\t{setting}\t{TUNED[setting]} -> {value}\t{reason}"
+    print(f"\n###   AUTOTUNE: {setting} {TUNED[setting]} -> {value} ({reason})   ###")
+    os.makedirs(CONFIG_DIR, exist_ok=True)
+    with open(os.path.join(CONFIG_DIR, 'autotune.log'), 'a', encoding='utf-8') as f:
+        f.write(line + '\n')
+    TUNED[setting] = value
+
+
+def autotune():
+    """ Backs off quickly when Spotify signals pressure and speeds up slowly while it does not """
+    if not AUTOTUNE:
+        API_CALLS.clear()
+        TRACK_RATES.clear()
+        STREAM_FAILURES.clear()
+        return
+
+    with TUNE_LOCK:
+        tune()
+
+
+def tune():
+    """ Applies the autotune rules to the observations so far, called with TUNE_LOCK held """
+    throttled = len([call for call in API_CALLS if call[1] == 429])
+    errors = len([call for call in API_CALLS if call[1] >= 500])
+    latencies = sorted(call[0] for call in API_CALLS)
+    wait, segments = get_tuned('wait'), get_tuned('segments')
+
+    if throttled or STREAM_FAILURES:
+        reason = f"{throttled} throttled request(s), {len(STREAM_FAILURES)} failed stream(s)"
+        set_tuned('wait', max(wait * 2, 1), AUTOTUNE_WAIT, reason)
+        set_tuned('segments', segments // 2, AUTOTUNE_SEGMENTS, reason)
+    elif len(API_CALLS) >= AUTOTUNE_WINDOW:
+        median = latencies[len(latencies) // 2]
+        reason = f"{errors} server error(s), median latency {median * 1000:.0f}ms in {len(API_CALLS)} requests"
+        if errors > len(API_CALLS) * 0.05 or median > AUTOTUNE_LATENCY:
+            set_tuned('wait', wait * 1.5 + 1, AUTOTUNE_WAIT, reason)
+            set_tuned('segments', segments - 1, AUTOTUNE_SEGMENTS, reason)
+        elif errors == 0:
+            set_tuned('wait', wait - 1, AUTOTUNE_WAIT, reason)
+            set_tuned('segments', segments + 1, AUTOTUNE_SEGMENTS, reason)
+
+    if TRACK_RATES:
+        # read about a quarter of a second of data at a time
+        rate = sorted(TRACK_RATES)[len(TRACK_RATES) // 2]
+        chunk_size = get_tuned('chunk_size')
+        if not chunk_size / 2 < rate / 4 < chunk_size * 2:
+            set_tuned('chunk_size', rate / 4, AUTOTUNE_CHUNK_SIZE, f"median throughput {tqdm.format_sizeof(rate, 'B/s', 1024)}")
+
+    if throttled or STREAM_FAILURES or len(API_CALLS) >= AUTOTUNE_WINDOW:
+        API_CALLS.clear()
+        STREAM_FAILURES.clear()
+    if len(TRACK_RATES) >= AUTOTUNE_WINDOW:
+        TRACK_RATES.clear()
+
+
+def has_room(size, path):
+    """ Returns True if size more bytes fit in the in-flight budget and the free space of path """
+    if IN_FLIGHT_BYTES and IN_FLIGHT_BYTES + size > MAX_IN_FLIGHT_BYTES:
+        return False
+    os.makedirs(path, exist_ok=True)
+    return shutil.disk_usage(path).free - IN_FLIGHT_BYTES - size >= MIN_FREE_SPACE
+
+
+def reserve_bytes(item_id, size, path):
+    """ Reserves size bytes for an item about to be downloaded to path, pausing until they fit """
+    global IN_FLIGHT_BYTES
+    with BUDGET:
+        if not has_room(size, path):
+            print(f"\n###   PAUSED: WAITING FOR {tqdm.format_sizeof(size + MIN_FREE_SPACE, 'B', 1024)} FREE ON {path}   ###")
+            while not has_room(size, path):
+                # releases wake us up, disk space freed by others is noticed on the next poll
+                BUDGET.wait(timeout=30)
+        IN_FLIGHT_BYTES += size
+        RESERVATIONS[item_id] = RESERVATIONS.get(item_id, 0) + size
+
+
+def release_bytes(item_id):
+    """ Returns the bytes reserved for an item to the budget """
+    global IN_FLIGHT_BYTES
+    with BUDGET:
+        IN_FLIGHT_BYTES -= RESERVATIONS.pop(item_id, 0)
+        BUDGET.notify_all()
+
+
+def wait_for_disk_space(path):
+    """ Pauses until path has MIN_FREE_SPACE bytes free again """
+    reserve_bytes(None, 0, path)
+    release_bytes(None)
+
+
+def download_segmented(stream, file):
+    """ Fetches the chunks of a stream concurrently and writes each one at its own offset of file """
+    streamer = stream.input_stream
+    # librespot already read past the header, the file starts at the current position of the stream
+    start = streamer.stream().pos()
+    chunk_size = ChannelManager.chunk_size
+    file.truncate(streamer.size - start)
+    lock = threading.Lock()
+
+    def fetch_segment(index):
+        # request_chunk downloads the byte range of the chunk and decrypts it into the streamer's buffer
+        if not streamer.available[index]:
+            streamer.request_chunk(index)
+        data = streamer.buffer[index][max(start - index * chunk_size, 0):]
+        streamer.buffer[index] = b""
+        position = max(index * chunk_size - start, 0)
+        if hasattr(os, 'pwrite'):
+            os.pwrite(file.fileno(), data, position)
+        else:
+            with lock:
+                file.seek(position)
+                file.write(data)
+        return len(data)
+
+    written = 0
+    with ThreadPoolExecutor(max_workers=get_tuned('segments')) as pool:
+        segments = [pool.submit(fetch_segment, index) for index in range(start // chunk_size, streamer.chunks)]
+        for segment in as_completed(segments):
+            size = segment.result()
+            written += size
+            item_progress(size)
+    if written != streamer.size - start:
+        raise IOError(f"segments hold {written} of {streamer.size - start} bytes")
+
+
 def search(search_term):
     """ Searches Spotify's API for relevant data """
+    set_stage("search")
     token = SESSION.tokens().get("user-read-email")
 
-    resp = requests.get(
-        "https://api.spotify.com/v1/search",
-        {
-            "limit": LIMIT,
-            "offset": "0",
-            "q": search_term,
-            "type": "track,album,playlist,artist"
-        },
-        headers={"Authorization": "Bearer %s" % token},
-    )
+    if search_term not in SEARCH_CACHE:
+        SEARCH_CACHE[search_term] = api_get(
+            "https://api.spotify.com/v1/search",
+            {
+                "limit": LIMIT,
+                "offset": "0",
+                "q": search_term,
+                "type": "track,album,playlist,artist"
+            },
+            headers={"Authorization": "Bearer %s" % token},
+        ).json()
+    results = SEARCH_CACHE[search_term]
     #print("token: ",token)
 
+    # fetch the listings of the top results while the user is still reading them
+    for album in results["albums"]["items"][:PREFETCH_RESULTS]:
+        prefetch(get_album_name, token, album['id'])
+        prefetch(get_album_tracks, token, album['id'])
+    for playlist in results["playlists"]["items"][:PREFETCH_RESULTS]:
+        if playlist['tracks']['total'] <= 100:
+            prefetch(get_playlist_songs, token, playlist['id'])
+    for artist in results["artists"]["items"][:PREFETCH_RESULTS]:
+        prefetch(get_albums_artist, token, artist['id'])
+
     i = 1
-    tracks = resp.json()["tracks"]["items"]
+    tracks = results["tracks"]["items"]
     if len(tracks) > 0:
         print("###  TRACKS  ###")
         for track in tracks:
@@ -429,7 +941,7 @@ def search(search_term):
     else:
         total_tracks = 0
 
-    albums = resp.json()["albums"]["items"]
+    albums = results["albums"]["items"]
     if len(albums) > 0:
         print("###  ALBUMS  ###")
         for album in albums:
@@ -442,7 +954,7 @@ def search(search_term):
     else:
         total_albums = 0
 
-    playlists = resp.json()["playlists"]["items"]
+    playlists = results["playlists"]["items"]
     total_playlists = 0
     print("###  PLAYLISTS  ###")
     for playlist in playlists:
@@ -451,7 +963,7 @@ def search(search_term):
     total_playlists = i - total_albums - total_tracks  - 1
     print("\n")
 
-    artists = resp.json()["artists"]["items"]
+    artists = results["artists"]["items"]
     total_artists = 0
     print("###  ARTIST  ###")
     for artist in artists:
@@ -467,6 +979,9 @@ def search(search_term):
 
         selection = str(input("SELECT ITEM(S) BY ID: "))
         inputs = split_input(selection)
+        listed = tracks + albums + playlists + artists
+        cancel_prefetch({listed[int(pos) - 1]['id'] for pos in inputs
+                         if str(pos).strip().isdigit() and 0 < int(pos) <= len(listed)})
         
         if not selection: client()
         
@@ -482,19 +997,25 @@ def search(search_term):
                 #print("==> position: ", position ," total_albums + total_tracks + total_playlists ", total_albums + total_tracks + total_playlists )
                 playlist_choice = playlists[position -
                                             total_tracks - total_albums - 1]
-                playlist_songs = get_playlist_songs(token, playlist_choice['id'])
+                playlist_songs = prefetched(get_playlist_songs, token, playlist_choice['id'])
+                start_job("playlist", playlist_choice['name'].strip(), len(playlist_songs))
                 for song in playlist_songs:
                     if song['track']['id'] is not None:
                         download_track(song['track']['id'], sanitize_data(
                             playlist_choice['name'].strip()) + "/")
-                        print("\n")
+                end_job()
             else:
                 #5eyTLELpc4Coe8oRTHkU3F
                 #print("==> position: ", position ," total_albums + total_tracks + total_playlists: ", position - total_albums - total_tracks - total_playlists )
                 artists_choice = artists[position - total_albums - total_tracks - total_playlists - 1]
-                albums = get_albums_artist(token,artists_choice['id'])
+                albums = prefetched(get_albums_artist, token, artists_choice['id'])
                 i=0
 
+                for album in albums:
+                    if artists_choice['id'] == album['artists'][0]['id'] and album['album_type'] != 'single':
+                        prefetch(get_album_name, token, album['id'])
+                        prefetch(get_album_tracks, token, album['id'])
+
                 print("\n")
                 print("ALL ALBUMS: ",len(albums)," IN:",str(set(album['album_type'] for album in albums)))
                 
@@ -508,12 +1029,6 @@ def search(search_term):
 
                 #print('\n'.join([f"{album['name']} - [{album['album_type']}] | {'/'.join([artist['name'] for artist in album['artists']])} " for album in sorted(albums, key=lambda k: k['album_type'], reverse=True)]))
 
-                
-                for i in range(8)[::-1]:
-                    print("\rWait for Download in %d second(s)..." % (i + 1), end="")
-                    time.sleep(1)
-                
-                print("\n")
                 i=0
                 for album in albums:
                     if artists_choice['id'] == album['artists'][0]['id'] and album['album_type'] != 'single' :
@@ -521,16 +1036,16 @@ def search(search_term):
                         year = re.search('(\d{4})', album['release_date']).group(1)
                         print(f"\n\n\n{i}/{total_albums_downloads} {album['artists'][0]['name']} - ({year}) {album['name']} [{album['total_tracks']}]")
                         download_album(album['id'])
-                        for i in range(ANTI_BAN_WAIT_TIME_ALBUMS)[::-1]:
-                            print("\rWait for Next Download in %d second(s)..." % (i + 1), end="")
-                            time.sleep(1)
+                        wait(ANTI_BAN_WAIT_TIME_ALBUMS)
+
+        cancel_prefetch()
 
 def get_song_info(song_id):
     """ Retrieves metadata for downloaded songs """
     token = SESSION.tokens().get("user-read-email")
     try:
 
-        info = json.loads(requests.get("https://api.spotify.com/v1/tracks?ids=" + song_id +
+        info = json.loads(api_get("https://api.spotify.com/v1/tracks?ids=" + song_id +
                         '&market=from_token', headers={"Authorization": "Bearer %s" % token}).text)
 
         artists = []
@@ -538,14 +1053,15 @@ def get_song_info(song_id):
             artists.append(sanitize_data(data['name']))
         album_name = sanitize_data(info['tracks'][0]['album']["name"])
         name = sanitize_data(info['tracks'][0]['name'])
-        image_url = info['tracks'][0]['album']['images'][2]['url']
+        image_url = get_cover_url(info['tracks'][0]['album']['images'])
         release_year = info['tracks'][0]['album']['release_date'].split("-")[0]
         disc_number = info['tracks'][0]['disc_number']
         track_number = info['tracks'][0]['track_number']
         scraped_song_id = info['tracks'][0]['id']
         is_playable = info['tracks'][0]['is_playable']
+        duration_ms = info['tracks'][0]['duration_ms']
 
-        return artists, album_name, name, image_url, release_year, disc_number, track_number, scraped_song_id, is_playable
+        return artists, album_name, name, image_url, release_year, disc_number, track_number, scraped_song_id, is_playable, duration_ms
     except Exception as e:
         print("###   get_song_info - FAILED TO QUERY METADATA   ###")
         print(e)
@@ -559,16 +1075,78 @@ def check_premium():
 
 # Functions directly related to modifying the downloaded audio and its metadata
 def convert_audio_format(filename):
-    """ Converts raw audio into playable mp3 or ogg vorbis """
+    """ Converts raw audio into playable mp3 or ogg vorbis, returns the EBU R128 integrated loudness (LUFS)
+    and true peak (dBTP) measured while encoding """
     global MUSIC_FORMAT
     #print("###   CONVERTING TO " + MUSIC_FORMAT.upper() + "   ###")
     raw_audio = AudioSegment.from_file(filename, format="ogg",
                                        frame_rate=44100, channels=2, sample_width=2)
+    # the decoded pcm is piped to ffmpeg ourselves rather than through AudioSegment.export, so the ebur128
+    # filter measures the loudness in the same pass that encodes it. ebur128 only works at 48 kHz, it gets its
+    # own asplit branch (discarded to the null muxer) so the encoded audio keeps the original sample rate
+    process = subprocess.run([AudioSegment.converter, '-y', '-hide_banner', '-nostats',
+                              '-f', PCM_FORMATS[raw_audio.sample_width], '-ar', str(raw_audio.frame_rate),
+                              '-ac', str(raw_audio.channels), '-i', 'pipe:0',
+                              '-filter_complex', '[0:a]asplit=2[encode][measure];'
+                                                 '[measure]ebur128=peak=true[measured]',
+                              '-map', '[encode]'] + (['-c:a', 'libvorbis'] if MUSIC_FORMAT == "ogg" else []) +
+                             ['-b:a', f"{get_bitrate()}k", '-f', MUSIC_FORMAT, filename,
+                              '-map', '[measured]', '-f', 'null', '-'],
+                             input=raw_audio.raw_data, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    log = process.stderr.decode('utf-8', 'ignore')
+    if process.returncode != 0:
+        raise CouldntEncodeError(f"Encoding failed. ffmpeg returned error code: {process.returncode}\n\n{log}")
+
+    loudness = re.findall(r'I:\s+(-?[\d.]+) LUFS', log)
+    peak = re.findall(r'Peak:\s+(-?[\d.]+|-inf) dBFS', log)
+    if not loudness or not peak:
+        return None, None
+    return float(loudness[-1]), float(peak[-1])
+
+
+def get_replaygain(loudness, peak):
+    """ Returns the ReplayGain gain and peak tag values for a loudness (LUFS) and true peak (dBTP) """
+    return f"{REPLAYGAIN_REFERENCE - loudness:.2f} dB", f"{10 ** (peak / 20):.6f}"
+
+
+def set_album_gain(tracks):
+    """ Writes the album ReplayGain tags once every track of an album has been converted. tracks holds
+    (filename, loudness, peak, duration_ms), loudness is None for tracks that were already on disk, those are
+    read back from their track gain tags """
+    measured = []
+    for filename, loudness, peak, duration_ms in tracks:
+        if not os.path.isfile(filename):
+            continue
+        if loudness is None:
+            tags = ID3(filename)
+            if 'TXXX:REPLAYGAIN_TRACK_GAIN' not in tags or 'TXXX:REPLAYGAIN_TRACK_PEAK' not in tags:
+                print("###   SKIPPING ALBUM GAIN: " + os.path.basename(filename) + " HAS NO TRACK GAIN   ###")
+                return
+            loudness = REPLAYGAIN_REFERENCE - float(tags['TXXX:REPLAYGAIN_TRACK_GAIN'].text[0].split()[0])
+            peak = 20 * math.log10(max(float(tags['TXXX:REPLAYGAIN_TRACK_PEAK'].text[0]), 1e-10))
+            duration_ms = open_audio(filename).info.length * 1000
+        measured.append((filename, loudness, peak, duration_ms))
+
+    if not measured:
+        return
+
+    # the album loudness is the duration weighted energy mean of its tracks
+    total_ms = sum(duration_ms for filename, loudness, peak, duration_ms in measured)
+    album_loudness = 10 * math.log10(sum(duration_ms * 10 ** (loudness / 10)
+                                         for filename, loudness, peak, duration_ms in measured) / total_ms)
+    album_gain, album_peak = get_replaygain(album_loudness, max(peak for filename, loudness, peak, duration_ms in measured))
+    for filename, loudness, peak, duration_ms in measured:
+        tags = ID3(filename)
+        tags.add(TXXX(encoding=3, desc=u'REPLAYGAIN_ALBUM_GAIN', text=album_gain))
+        tags.add(TXXX(encoding=3, desc=u'REPLAYGAIN_ALBUM_PEAK', text=album_peak))
+        tags.save()
+
+
+def get_bitrate():
+    """ Returns the bitrate in kbps of the current session's quality """
     if QUALITY == AudioQuality.VERY_HIGH:
-        bitrate = "320k"
-    else:
-        bitrate = "160k"
-    raw_audio.export(filename, format=MUSIC_FORMAT, bitrate=bitrate)
+        return 320
+    return 160
 
 
 def set_audio_tags(filename, artists, name, album_name, release_year, disc_number, track_number, track_id_str):
@@ -585,9 +1163,20 @@ def set_audio_tags(filename, artists, name, album_name, release_year, disc_numbe
     tags.save()
 
 
-def set_audio_tags_mutagen(filename, artists, name, album_name, release_year, disc_number, track_number, track_id_str, image_url):
+def set_audio_tags_mutagen(filename, artists, name, album_name, release_year, disc_number, track_number, track_id_str, image_url, loudness=None, peak=None):
     """ sets music_tag metadata using mutagen """
-    albumart = requests.get(image_url).content
+    tags = ID3(filename)
+    for frame in get_id3_frames(filename, artists, name, album_name, release_year, disc_number, track_number, track_id_str, get_cover(image_url)):
+        tags.setall(frame.FrameID, [frame])
+    if loudness is not None:
+        track_gain, track_peak = get_replaygain(loudness, peak)
+        tags.add(TXXX(encoding=3, desc=u'REPLAYGAIN_TRACK_GAIN', text=track_gain))
+        tags.add(TXXX(encoding=3, desc=u'REPLAYGAIN_TRACK_PEAK', text=track_peak))
+    tags.save()
+
+
+def get_id3_frames(filename, artists, name, album_name, release_year, disc_number, track_number, track_id_str, albumart):
+    """ Returns the ID3 frames zspotify sets on a song """
     artist = conv_artist_format(artists)
     check_various_artists = "Various Artists" in filename
     if check_various_artists:
@@ -595,24 +1184,38 @@ def set_audio_tags_mutagen(filename, artists, name, album_name, release_year, di
     else:
         album_artist = artist
 
-    tags = ID3(filename)
-    tags['TPE1'] = TPE1(encoding=3, text=artist)             # TPE1 Lead Artist/Performer/Soloist/Group
-    tags['TIT2'] = TIT2(encoding=3, text=name)               # TIT2 Title/songname/content description
-    tags['TALB'] = TALB(encoding=3, text=album_name)         # TALB Album/Movie/Show title
-    tags['TDRC'] = TDRC(encoding=3, text=release_year)       # TDRC Recording time
-    tags['TDOR'] = TDOR(encoding=3, text=release_year)       # TDOR Original release time
-    tags['TPOS'] = TPOS(encoding=3, text=str(disc_number))   # TPOS Part of a set
-    tags['TRCK'] = TRCK(encoding=3, text=str(track_number))  # TRCK Track number/Position in set
-    tags['COMM'] = COMM(encoding=3, lang=u'eng', text=u'id[spotify.com:track:'+track_id_str+']') #COMM User comment
-    tags['TPE2'] = TPE2(encoding=3, text=album_artist)       # TPE2 Band/orchestra/accompaniment
-    tags['APIC'] = APIC(                                     # APIC Attached (or linked) Picture.
-                        encoding=3,
-                        mime='image/jpeg',
-                        type=3,
-                        desc=u'0',
-                        data=requests.get(image_url).content)
-   #tags['TCON'] = TCON(encoding=3, text=genre)              # TCON Genre - TODO
-    tags.save()
+    return [
+        TPE1(encoding=3, text=artist),                # TPE1 Lead Artist/Performer/Soloist/Group
+        TIT2(encoding=3, text=name),                  # TIT2 Title/songname/content description
+        TALB(encoding=3, text=album_name),            # TALB Album/Movie/Show title
+        TDRC(encoding=3, text=release_year),          # TDRC Recording time
+        TDOR(encoding=3, text=release_year),          # TDOR Original release time
+        TPOS(encoding=3, text=str(disc_number)),      # TPOS Part of a set
+        TRCK(encoding=3, text=str(track_number)),     # TRCK Track number/Position in set
+        COMM(encoding=3, lang=u'eng', text=u'id[spotify.com:track:'+track_id_str+']'), #COMM User comment
+        TPE2(encoding=3, text=album_artist),          # TPE2 Band/orchestra/accompaniment
+        APIC(                                         # APIC Attached (or linked) Picture.
+            encoding=3,
+            mime='image/jpeg',
+            type=3,
+            desc=u'0',
+            data=albumart),
+       #TCON(encoding=3, text=genre),                 # TCON Genre - TODO
+    ]
+
+
+def get_cover(image_url):
+    """ Returns the cover artwork at image_url, downloading each cover once """
+    if image_url not in COVER_CACHE:
+        if len(COVER_CACHE) >= 64:
+            COVER_CACHE.clear()
+        COVER_CACHE[image_url] = requests.get(image_url).content
+    return COVER_CACHE[image_url]
+
+
+def get_cover_url(images):
+    """ Returns the url of the largest cover of an album """
+    return max(images, key=lambda image: image['width'] or 0)['url']
 
 
 def set_music_thumbnail(filename, image_url):
@@ -642,7 +1245,7 @@ def get_all_playlists(access_token):
     while True:
         headers = {'Authorization': f'Bearer {access_token}'}
         params = {'limit': limit, 'offset': offset}
-        resp = requests.get("https://api.spotify.com/v1/me/playlists",
+        resp = api_get("https://api.spotify.com/v1/me/playlists",
                             headers=headers, params=params).json()
         offset += limit
         playlists.extend(resp['items'])
@@ -661,8 +1264,8 @@ def get_playlist_songs(access_token, playlist_id):
 
     while True:
         headers = {'Authorization': f'Bearer {access_token}'}
-        params = {'limit': limit, 'offset': offset}
-        resp = requests.get(
+        params = {'limit': limit, 'offset': offset, 'market': 'from_token'}
+        resp = api_get(
             f'https://api.spotify.com/v1/playlists/{playlist_id}/tracks', headers=headers, params=params).json()
         offset += limit
         songs.extend(resp['items'])
@@ -676,7 +1279,7 @@ def get_playlist_songs(access_token, playlist_id):
 def get_playlist_info(access_token, playlist_id):
     """ Returns information scraped from playlist """
     headers = {'Authorization': f'Bearer {access_token}'}
-    resp = requests.get(
+    resp = api_get(
         f'https://api.spotify.com/v1/playlists/{playlist_id}?fields=name,owner(display_name)&market=from_token', headers=headers).json()
     return resp['name'].strip(), resp['owner']['display_name'].strip()
 
@@ -691,8 +1294,8 @@ def get_album_tracks(access_token, album_id):
 
     while True:
         headers = {'Authorization': f'Bearer {access_token}'}
-        params = {'limit': limit, 'include_groups':include_groups, 'offset': offset}
-        resp = requests.get(
+        params = {'limit': limit, 'include_groups':include_groups, 'offset': offset, 'market': 'from_token'}
+        resp = api_get(
             f'https://api.spotify.com/v1/albums/{album_id}/tracks', headers=headers, params=params).json()
         offset += limit
         songs.extend(resp['items'])
@@ -706,7 +1309,7 @@ def get_album_tracks(access_token, album_id):
 def get_album_name(access_token, album_id):
     """ Returns album name """
     headers = {'Authorization': f'Bearer {access_token}'}
-    resp = requests.get(
+    resp = api_get(
         f'https://api.spotify.com/v1/albums/{album_id}', headers=headers).json()
     
     #_yearalbum = re.search('(\d{4})', resp['release_date']).group(1)
@@ -720,7 +1323,7 @@ def get_album_name(access_token, album_id):
 def get_artist_albums(access_token, artist_id):
     """ Returns artist's albums """
     headers = {'Authorization': f'Bearer {access_token}'}
-    resp = requests.get(
+    resp = api_get(
         f'https://api.spotify.com/v1/artists/{artist_id}/albums', headers=headers).json()
     # Return a list each album's id
     return [resp['items'][i]['id'] for i in range(len(resp['items']))]
@@ -736,8 +1339,8 @@ def get_saved_tracks(access_token):
 
     while True:
         headers = {'Authorization': f'Bearer {access_token}'}
-        params = {'limit': limit, 'offset': offset}
-        resp = requests.get('https://api.spotify.com/v1/me/tracks',
+        params = {'limit': limit, 'offset': offset, 'market': 'from_token'}
+        resp = api_get('https://api.spotify.com/v1/me/tracks',
                             headers=headers, params=params).json()
         offset += limit
         songs.extend(resp['items'])
@@ -761,40 +1364,470 @@ def get_previously_downloaded() -> list[str]:
 
     return ids
 
-def add_to_archive(song_id: str, filename: str, author_name: str, song_name: str) -> None:
+def add_to_archive(song_id: str, filename: str, author_name: str, song_name: str, bitrate: int = None) -> None:
     """ Adds song id to all time installed songs archive """
+    add_entries_to_archive([(song_id, filename, author_name, song_name, bitrate)])
+
+
+def add_entries_to_archive(entries) -> None:
+    """ Adds (song id, filename, author name, song name, bitrate) entries to the archive in a single write """
 
     archive_path = os.path.join(os.path.dirname(__file__), ROOT_PATH, '.song_archive')
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    if os.path.exists(archive_path):
+    with archive_lock():
         with open(archive_path, 'a', encoding='utf-8') as file:
-            file.write(f'{song_id}\t{datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\t{author_name}\t{song_name}\t{filename}\n')
-    else:
-        with open(archive_path, 'w', encoding='utf-8') as file:
-            file.write(f'{song_id}\t{datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\t{author_name}\t{song_name}\t{filename}\n')
+            file.write(''.join(f'{song_id}\t{now}\t{author_name}\t{song_name}\t{filename}\t{bitrate or ""}\n'
+                               for song_id, filename, author_name, song_name, bitrate in entries))
+
+
+def remove_from_archive(song_ids) -> None:
+    """ Removes songs from the all time installed songs archive so they can be downloaded again """
+    archive_path = os.path.join(ROOT_PATH, '.song_archive')
+
+    with archive_lock():
+        if os.path.exists(archive_path):
+            with open(archive_path, 'r', encoding='utf-8') as f:
+                lines = [line for line in f.readlines() if line.strip().split('\t')[0] not in song_ids]
+            rewrite_archive(archive_path, lines)
+
+
+def set_archive_bitrates(bitrates: dict) -> None:
+    """ Records the bitrate tier (kbps) of songs, keyed by song id, in the archive """
+    archive_path = os.path.join(ROOT_PATH, '.song_archive')
+
+    with archive_lock():
+        if os.path.exists(archive_path):
+            with open(archive_path, 'r', encoding='utf-8') as f:
+                lines = [line.rstrip('\n').split('\t') for line in f.readlines()]
+            for columns in lines:
+                if columns[0] in bitrates and len(columns) >= 5:
+                    columns[5:] = [str(bitrates[columns[0]])]
+            rewrite_archive(archive_path, ['\t'.join(columns) + '\n' for columns in lines])
+
+
+def rewrite_archive(archive_path: str, lines) -> None:
+    """ Replaces the archive with lines. The new archive is written next to it and renamed over it, so a crash
+    or a full disk never leaves a truncated archive and readers without the lock see the old or the new one """
+    try:
+        with open(archive_path + '.' + WORKER_ID, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(archive_path + '.' + WORKER_ID, archive_path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(archive_path + '.' + WORKER_ID)
+        raise
+
+
+# Functions related to sharing ROOT_PATH between several workers
+def get_lease_path(name: str) -> str:
+    """ Returns the lease file of name """
+    return os.path.join(ROOT_PATH, '.leases', name + '.lease')
+
+
+def acquire_lease(name: str, lease_time: int = LEASE_TIME) -> bool:
+    """ Claims name for this worker, taking over leases that were not renewed for lease_time seconds """
+    path = get_lease_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(path) < lease_time:
+                return False
+            # renaming is atomic, so only one of the workers noticing the expired lease moves it away. It is
+            # never renamed back (that could overwrite a lease created meanwhile), the O_EXCL create decides
+            # who gets the lease
+            tombstone = f"{path}.{WORKER_ID}.{time.time_ns()}.stale"
+            os.rename(path, tombstone)
+            os.remove(tombstone)
+        except OSError:
+            return False
+        return acquire_lease(name, lease_time)
+
+    with os.fdopen(fd, 'w') as f:
+        f.write(WORKER_ID)
+    return True
+
+
+def release_lease(name: str) -> None:
+    """ Gives up a lease so other workers can claim it, unless another worker took it over """
+    with contextlib.suppress(OSError):
+        with open(get_lease_path(name), 'r', encoding='utf-8') as f:
+            owner = f.read()
+        if owner == WORKER_ID:
+            os.remove(get_lease_path(name))
+
+
+def renew_leases(names, stop: threading.Event, interval: float = LEASE_TIME / 3) -> None:
+    """ Keeps leases from expiring until stop is set """
+    while not stop.wait(interval):
+        for name in names:
+            with contextlib.suppress(OSError):
+                os.utime(get_lease_path(name))
+
+
+@contextlib.contextmanager
+def archive_lock():
+    """ Serializes writes to the archive and library index between workers """
+    if not MULTI_NODE:
+        yield
+        return
+    while not acquire_lease('song_archive', lease_time=30):
+        time.sleep(0.1)
+    # renewed while held, a slow rewrite over the network must not lose the lock halfway
+    stop = threading.Event()
+    threading.Thread(target=renew_leases, args=(['song_archive'], stop, 10), daemon=True).start()
+    try:
+        yield
+    finally:
+        stop.set()
+        release_lease('song_archive')
+
+
+def claim_track(track_id_str: str, filename: str) -> bool:
+    """ Claims a track and the file it is saved to for this worker until release_track is called """
+    if not MULTI_NODE or track_id_str in LEASES:
+        return True
+
+    names = [track_id_str, 'file-' + hashlib.sha1(os.path.relpath(filename, ROOT_PATH).encode()).hexdigest()]
+    if not acquire_lease(names[0]):
+        return False
+    if not acquire_lease(names[1]):
+        release_lease(names[0])
+        return False
+
+    stop = threading.Event()
+    threading.Thread(target=renew_leases, args=(names, stop), daemon=True).start()
+    LEASES[track_id_str] = (names, stop)
+    return True
+
+
+def release_track(track_id_str: str) -> None:
+    """ Releases a track claimed with claim_track """
+    if track_id_str in LEASES:
+        names, stop = LEASES.pop(track_id_str)
+        stop.set()
+        for name in names:
+            release_lease(name)
+
+
+def download_claimed_tracks() -> None:
+    """ Revisits the tracks other workers had claimed, taking over those whose worker stopped """
+    while CLAIMED_ELSEWHERE:
+        time.sleep(LEASE_TIME / 3)
+        pending = CLAIMED_ELSEWHERE[:]
+        CLAIMED_ELSEWHERE.clear()
+        print(f"###   CHECKING {len(pending)} TRACK(S) CLAIMED BY OTHER WORKERS   ###")
+        for args, kwargs in pending:
+            download_track(*args, **kwargs)
+
+
+# Functions related to the library index, a hidden file at the download location that records what every
+# downloaded file is (spotify id, expected duration) and the result of its last verification.
+# Each line is a JSON object, later lines for the same path update the earlier ones.
+def load_library_index() -> dict:
+    """ Returns the library index keyed by file path """
+    index = {}
+    index_path = os.path.join(ROOT_PATH, '.library_index')
+
+    if os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    index.setdefault(entry['path'], {}).update(entry)
+
+    return index
+
+
+def update_library_index(path: str, **fields) -> None:
+    """ Records fields about a file in the library index """
+    add_library_index_entries([dict(fields, path=path)])
+
+
+def add_library_index_entries(entries) -> None:
+    """ Records several library index entries, each holding its path, in a single write """
+    index_path = os.path.join(ROOT_PATH, '.library_index')
+
+    with archive_lock():
+        with open(index_path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+
+
+# Functions related to reusing recordings we already downloaded under another track id
+def get_recordings() -> dict:
+    """ Returns the files of the library keyed by audio file id and by ISRC, loaded once per run """
+    global RECORDINGS
+    if RECORDINGS is None:
+        RECORDINGS = {}
+        for path, entry in load_library_index().items():
+            remember_recording(path, entry.get('file_id'), entry.get('isrc'), entry.get('bitrate'))
+    return RECORDINGS
+
+
+def remember_recording(path: str, file_id: str, isrc: str, bitrate: int = None) -> None:
+    """ Records which file holds an audio file id and ISRC """
+    if RECORDINGS is None:
+        get_recordings()
+    if file_id:
+        RECORDINGS['file:' + file_id] = (path, bitrate)
+    if isrc:
+        RECORDINGS['isrc:' + isrc] = (path, bitrate)
+
+
+def find_duplicate(file_id: str, isrc: str, filename: str, work_filename: str):
+    """ Returns a file of the library holding the same audio, other than the filename (or its work_filename)
+    about to be written, or None """
+    if DEDUP_MODE == "off":
+        return None
+    recordings = get_recordings()
+    for key in ['file:' + file_id] + (['isrc:' + isrc] if isrc else []):
+        path, bitrate = recordings.get(key, (None, None))
+        # a file of another container (after MUSIC_FORMAT changed, or RAW_AUDIO_AS_IS) cannot take the new track's tags
+        if path is not None and not path.lower().endswith('.' + MUSIC_FORMAT.lower()):
+            continue
+        # the track's own file (SKIP_EXISTING_FILES off, or already linked) would be copied over itself
+        if path in (filename, work_filename):
+            continue
+        # after an account upgrade, a lower quality copy would bring back what --upgrade replaces
+        if path is not None and is_existing_file(path) and \
+                (bitrate or get_tier(read_quality(path)[0]) or 0) < get_bitrate():
+            continue
+        if path is not None and is_existing_file(path):
+            return path
+        if path is not None and is_staged(None, path):
+            staged = next(entry['staged'] for entry in STAGED if entry['filename'] == path)
+            if staged != work_filename:
+                return staged
+    return None
+
+
+def reuse_duplicate(duplicate: str, filename: str, work_filename: str) -> bool:
+    """ Hard links duplicate to filename, or copies it to work_filename to be tagged for the new track.
+    Returns True if it was linked """
+    if DEDUP_MODE == "link" and duplicate.startswith(ROOT_PATH):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        try:
+            os.link(duplicate, filename)
+            return True
+        except OSError:
+            pass
+    os.makedirs(os.path.dirname(work_filename), exist_ok=True)
+    shutil.copyfile(duplicate, work_filename)
+    return False
+
+
+# Functions related to rewriting the tags of the library
+def read_embedded_id(path):
+    """ Returns the spotify track id in the comment tag of a library file, or None """
+    try:
+        comments = ID3(path).getall('COMM')
+    except mutagen.MutagenError:
+        return None
+    track_id = re.search(r'spotify\.com:track:([0-9a-zA-Z]{22})', str(comments[0])) if comments else None
+    return track_id.group(1) if track_id else None
+
+
+def frame_matches(tags, frame):
+    """ Returns True if tags already hold frame """
+    existing = tags.getall(frame.FrameID)
+    if not existing:
+        return False
+    if frame.FrameID == 'APIC':
+        return existing[0].data == frame.data
+    return [str(text) for text in existing[0].text] == [str(text) for text in frame.text]
+
+
+def retag_file(path, track, albumart):
+    """ Rewrites the tags of a library file from its track metadata, returns False if they already matched """
+    frames = get_id3_frames(path, [sanitize_data(artist['name']) for artist in track['artists']],
+                            sanitize_data(track['name']), sanitize_data(track['album']['name']),
+                            track['album']['release_date'].split("-")[0], track['disc_number'],
+                            track['track_number'], track['id'], albumart)
+    tags = ID3(path)
+    if all(frame_matches(tags, frame) for frame in frames):
+        return False
+    for frame in frames:
+        tags.setall(frame.FrameID, [frame])
+    tags.save()
+    return True
+
+
+def retag_album(files):
+    """ Retags the (path, track) files of one album, downloading its cover once. Returns how many changed """
+    albumart = requests.get(get_cover_url(files[0][1]['album']['images'])).content
+    return sum(retag_file(path, track, albumart) for path, track in files)
+
+
+def retag_library():
+    """ Rewrites the tags of every mp3 of the library from fresh metadata, without downloading the audio again """
+    token = SESSION.tokens().get("user-read-email")
+    index = load_library_index()
+    paths = sorted({path for path in index if path.lower().endswith('.mp3') and os.path.isfile(path)} |
+                   {path for path, mtime, size in get_library_files() if path.lower().endswith('.mp3')})
+
+    with ThreadPoolExecutor(max_workers=RETAG_WORKERS) as pool:
+        embedded_ids = dict(zip(paths, tqdm(pool.map(read_embedded_id, paths), total=len(paths), unit='File', desc='Reading tags')))
+        track_ids = sorted({track_id for track_id in embedded_ids.values() if track_id})
+        tracks = {track_id: track for track_id, track in zip(track_ids, get_tracks_info(token, track_ids)) if track}
+
+        albums = {}
+        for path, track_id in embedded_ids.items():
+            if track_id in tracks and tracks[track_id]['album']['images']:
+                albums.setdefault(tracks[track_id]['album']['id'], []).append((path, tracks[track_id]))
+        total = sum(len(files) for files in albums.values())
+        changed = sum(tqdm(pool.map(retag_album, albums.values()), total=len(albums), unit='Album', desc='Retagging'))
+
+    print(f"###   RETAGGED {changed} FILE(S), {total - changed} ALREADY UP TO DATE, "
+          f"{len(paths) - total} WITHOUT SPOTIFY METADATA   ###")
+
+
+# Functions related to downloading again the tracks of the library that are below the session's quality
+def read_quality(path):
+    """ Returns the bitrate (kbps) and spotify track id of a library file, reading only its headers """
+    try:
+        audio = open_audio(path)
+    except mutagen.MutagenError:
+        return None, None
+    if audio is None or not audio.info.bitrate:
+        return None, None
+    comments = audio.tags.getall('COMM') if hasattr(audio.tags, 'getall') else []
+    track_id = re.search(r'spotify\.com:track:([0-9a-zA-Z]{22})', str(comments[0])) if comments else None
+    return audio.info.bitrate // 1000, track_id.group(1) if track_id else None
+
+
+def get_tier(bitrate):
+    """ Returns the quality tier (kbps) closest to a measured bitrate, or None """
+    if bitrate is None:
+        return None
+    return min(QUALITY_TIERS, key=lambda tier: abs(tier - bitrate))
+
+
+def upgrade_library():
+    """ Records the quality tier of every track of the library, then downloads again, in place, the tracks below
+    the current session's quality """
+    index = load_library_index()
+    paths = sorted(path for path, mtime, size in get_library_files()
+                   if path.startswith(ROOT_PATH) and path.lower().endswith(('.mp3', '.ogg')))
+
+    with ThreadPoolExecutor(max_workers=UPGRADE_WORKERS) as pool:
+        qualities = list(tqdm(pool.map(read_quality, paths), total=len(paths), unit='File', desc='Reading headers'))
+
+    bitrates = {}
+    below = []
+    unknown = 0
+    for path, (bitrate, embedded_id) in zip(paths, qualities):
+        track_id = index.get(path, {}).get('id') or embedded_id
+        if bitrate is None or track_id is None:
+            unknown += 1
+            continue
+        entry = index.setdefault(path, {'path': path, 'type': 'track', 'id': track_id})
+        entry['bitrate'] = bitrates[track_id] = get_tier(bitrate)
+        if entry['bitrate'] < get_bitrate():
+            below.append(entry)
+    save_library_index(index)
+    set_archive_bitrates(bitrates)
+    print(f"###   {len(below)} OF {len(paths)} TRACK(S) BELOW {get_bitrate()} KBPS, "
+          f"{unknown} WITHOUT A SPOTIFY ID OR BITRATE   ###")
+
+    # a single archive rewrite, every track is added back once its replacement is in place
+    remove_from_archive({entry['id'] for entry in below})
+    start_job("upgrade", f"Upgrade to {get_bitrate()} kbps", len(below))
+    for entry in below:
+        download_track(entry['id'], replace_file=entry['path'])
+    end_job()
+
+
+# Functions related to the local staging folder
+def get_staging_filename(filename: str) -> str:
+    """ Returns where a file of ROOT_PATH is written before it is moved into place """
+    if not STAGING_PATH:
+        return filename
+    return os.path.join(STAGING_PATH, os.path.relpath(filename, ROOT_PATH))
+
+
+def is_staged(song_id: str, filename: str) -> bool:
+    """ Returns True if a song or its file is waiting in the staging folder """
+    return any(entry['id'] == song_id or entry['filename'] == filename for entry in STAGED)
+
+
+def flush_staging() -> None:
+    """ Moves the staged files to ROOT_PATH one after the other, then archives them with a single write """
+    if not STAGED:
+        return
+
+    moved = []
+    try:
+        for entry in STAGED:
+            reserve_bytes(entry['filename'], os.path.getsize(entry['staged']), ROOT_PATH)
+            try:
+                os.makedirs(os.path.dirname(entry['filename']), exist_ok=True)
+                # copy next to the destination first, so the rename into place is atomic even across file systems
+                shutil.copyfile(entry['staged'], entry['filename'] + '.part')
+                os.replace(entry['filename'] + '.part', entry['filename'])
+                os.remove(entry['staged'])
+            finally:
+                release_bytes(entry['filename'])
+            moved.append(entry)
+    finally:
+        if moved:
+            add_entries_to_archive([(entry['id'], os.path.basename(entry['filename']), entry['artist'], entry['name'],
+                                     entry['bitrate']) for entry in moved])
+            add_library_index_entries([{'path': entry['filename'], 'type': 'track', 'id': entry['id'],
+                                        'duration_ms': entry['duration_ms'], 'file_id': entry['file_id'],
+                                        'isrc': entry['isrc'], 'bitrate': entry['bitrate']} for entry in moved])
+        for entry in moved:
+            release_track(entry['id'])
+            STAGED.remove(entry)
+        print(f"\n###   MOVED {len(moved)} STAGED TRACK(S) TO {ROOT_PATH}   ###")
+
+
+def save_library_index(index: dict) -> None:
+    """ Rewrites the library index with one line per file """
+    index_path = os.path.join(ROOT_PATH, '.library_index')
+
+    os.makedirs(ROOT_PATH, exist_ok=True)
+    with archive_lock():
+        with open(index_path + '.' + WORKER_ID, 'w', encoding='utf-8') as f:
+            for entry in index.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(index_path + '.' + WORKER_ID, index_path)
 
 
 # Functions directly related to downloading stuff
-def download_track(track_id_str: str, extra_paths="", prefix=False, prefix_value='', disable_progressbar=False):
-    """ Downloads raw song audio from Spotify """
+def get_song_filename(artist, album_name, name, track_number, extra_paths="", prefix=False):
+    """ Returns the file name and full path a song is saved to """
+    if prefix:
+        _track_number = str(track_number).zfill(2)
+        song_name = f'{artist} - {album_name} - {_track_number}. {name}.{MUSIC_FORMAT}'
+    elif ALBUM_IN_FILENAME:
+        song_name = f'{artist} - {album_name} - {name}.{MUSIC_FORMAT}'
+    else:
+        song_name = f'{artist} - {name}.{MUSIC_FORMAT}'
+    return song_name, os.path.join(ROOT_PATH, extra_paths, song_name)
+
+
+@idle_after
+def download_track(track_id_str: str, extra_paths="", prefix=False, prefix_value='', disable_progressbar=False,
+                   replace_file=""):
+    """ Downloads raw song audio from Spotify. With replace_file, the song is downloaded again and atomically
+    replaces that file once it is converted and tagged """
     global ROOT_PATH, SKIP_EXISTING_FILES, SKIP_PREVIOUSLY_DOWNLOADED, MUSIC_FORMAT, RAW_AUDIO_AS_IS, ANTI_BAN_WAIT_TIME, OVERRIDE_AUTO_WAIT, ALBUM_IN_FILENAME
+    set_stage("metadata", track_id_str)
     try:
     	# TODO: ADD disc_number IF > 1 
-        artists, album_name, name, image_url, release_year, disc_number, track_number, scraped_song_id, is_playable = get_song_info(
+        artists, album_name, name, image_url, release_year, disc_number, track_number, scraped_song_id, is_playable, duration_ms = get_song_info(
             track_id_str)
 
-        _artist = artists[0]
-        if prefix:
-            _track_number = str(track_number).zfill(2)
-            song_name = f'{_artist} - {album_name} - {_track_number}. {name}.{MUSIC_FORMAT}' 
-            filename = os.path.join(ROOT_PATH, extra_paths, song_name)
-        elif ALBUM_IN_FILENAME:
-            song_name = f'{_artist} - {album_name} - {name}.{MUSIC_FORMAT}'
-            filename = os.path.join(ROOT_PATH, extra_paths, song_name)
-        else:
-            song_name = f'{_artist} - {name}.{MUSIC_FORMAT}'
-            filename = os.path.join(ROOT_PATH, extra_paths, song_name)
-        check_all_time = scraped_song_id in get_previously_downloaded()
+        song_name, filename = get_song_filename(artists[0], album_name, name, track_number, extra_paths, prefix)
+        if replace_file:
+            filename = replace_file
+        # without a staging folder a replacement is written next to the file it replaces
+        partial_filename = get_staging_filename(filename) if not replace_file or STAGING_PATH else filename + '.part'
+        item_started(scraped_song_id, song_name)
+        check_all_time = scraped_song_id in get_previously_downloaded() or is_staged(scraped_song_id, filename)
 
 
     except Exception as e:
@@ -802,19 +1835,31 @@ def download_track(track_id_str: str, extra_paths="", prefix=False, prefix_value
         print(f" download_track FAILED: [{track_id_str}][{extra_paths}][{prefix}][{prefix_value}][{disable_progressbar}]")
         print("SKIPPING SONG: ",e)
         print(f" download_track FAILED: [{artists}][{album_name}][{name}][{image_url}][{release_year}][{disc_number}][{track_number}][{scraped_song_id}][{is_playable}]")
+        item_finished("retry", track_id_str, track_id_str, "metadata query failed")
         time.sleep(60)
-        download_track(track_id_str, extra_paths,prefix=prefix, prefix_value=prefix_value, disable_progressbar=disable_progressbar)
+        download_track(track_id_str, extra_paths,prefix=prefix, prefix_value=prefix_value, disable_progressbar=disable_progressbar,
+                       replace_file=replace_file)
 
     else:
 
         try:
             if not is_playable:
-                print("###   SKIPPING:", song_name, "(SONG IS UNAVAILABLE)   ###")
+                item_finished("skipped", scraped_song_id, song_name, "song is unavailable")
             else:
-                if os.path.isfile(filename) and os.path.getsize(filename) and SKIP_EXISTING_FILES:
-                    print("###   SKIPPING: (SONG ALREADY EXISTS) :", song_name, "   ###")
+                if is_existing_file(filename) and SKIP_EXISTING_FILES and not replace_file:
+                    item_finished("skipped", scraped_song_id, song_name, "song already exists")
+                    if ALBUM_LOUDNESS is not None:
+                        ALBUM_LOUDNESS.append((filename, None, None, duration_ms))
                 elif check_all_time and SKIP_PREVIOUSLY_DOWNLOADED:
-                    print('###   SKIPPING: ' + song_name + ' (SONG ALREADY DOWNLOADED ONCE)   ###')
+                    item_finished("skipped", scraped_song_id, song_name, "song already downloaded once")
+                elif not claim_track(scraped_song_id, filename):
+                    item_finished("skipped", scraped_song_id, song_name, "song claimed by another worker")
+                    CLAIMED_ELSEWHERE.append(((track_id_str, extra_paths),
+                                              dict(prefix=prefix, prefix_value=prefix_value, disable_progressbar=disable_progressbar,
+                                                   replace_file=replace_file)))
+                elif MULTI_NODE and SKIP_PREVIOUSLY_DOWNLOADED and scraped_song_id in get_previously_downloaded():
+                    release_track(scraped_song_id)
+                    item_finished("skipped", scraped_song_id, song_name, "song downloaded by another worker")
                 else:
                     if track_id_str != scraped_song_id:
                         track_id_str = scraped_song_id
@@ -822,78 +1867,147 @@ def download_track(track_id_str: str, extra_paths="", prefix=False, prefix_value
                     track_id = TrackId.from_base62(track_id_str)
                     # print("###   FOUND SONG:", song_name, "   ###")
 
-                    stream = SESSION.content_feeder().load(
-                        track_id, VorbisOnlyAudioQuality(QUALITY), False, None)
-                    # print("###   DOWNLOADING RAW AUDIO   ###")
-
-                    #if not os.path.isdir(ROOT_PATH + extra_paths):
-                    os.makedirs(ROOT_PATH + extra_paths,exist_ok=True)
-
-                    total_size = stream.input_stream.size
-                    downloaded = 0
-                    _CHUNK_SIZE = CHUNK_SIZE
-                    fail = 0
-                    with open(filename, 'wb') as file, tqdm(
-                            desc=song_name,
-                            total=total_size,
-                            unit='B',
-                            unit_scale=True,
-                            unit_divisor=1024,
-                            disable=disable_progressbar
-                    ) as bar:
-                        while downloaded <= total_size:
-                            data = stream.input_stream.stream().read(_CHUNK_SIZE)
-
-                            downloaded += len(data)
-                            bar.update(file.write(data))
-                            #print(f"[{total_size}][{_CHUNK_SIZE}] [{len(data)}] [{total_size - downloaded}] [{downloaded}]")
-                            if (total_size - downloaded) < _CHUNK_SIZE:
-                                _CHUNK_SIZE = total_size - downloaded
-                            if len(data) == 0 : 
-                                fail += 1                                
-                            if fail > REINTENT_DOWNLOAD:
-                                break
-
-
-                    if not RAW_AUDIO_AS_IS:
-                        convert_audio_format(filename)
-                        if USE_MUTAGEN:
-                            set_audio_tags_mutagen(filename, artists, name, album_name,
-                                           release_year, disc_number, track_number, track_id_str, image_url)
-                        else:
-                            set_audio_tags(filename, artists, name, album_name,
-                                           release_year, disc_number, track_number, track_id_str)
-                            set_music_thumbnail(filename, image_url)
-
-                    if not OVERRIDE_AUTO_WAIT:
-                        time.sleep(ANTI_BAN_WAIT_TIME)
-
-                    add_to_archive(scraped_song_id, os.path.basename(filename), artists[0], name)
+                    # resolve the audio file before streaming it, recordings we already have are reused
+                    track = SESSION.content_feeder().pick_alternative_if_necessary(
+                        SESSION.api().get_metadata_4_track(track_id))
+                    if track is None:
+                        raise RuntimeError("Cannot get alternative track")
+                    audio_file = VorbisOnlyAudioQuality(QUALITY).get_file(track.file)
+                    if audio_file is None:
+                        raise RuntimeError("Cannot find suitable audio file")
+                    file_id = audio_file.file_id.hex()
+                    isrc = next((external_id.id for external_id in track.external_id if external_id.type.lower() == 'isrc'), None)
+                    # the file being replaced is the recording itself, it must not be reused
+                    duplicate = find_duplicate(file_id, isrc, filename, partial_filename) if not replace_file else None
+
+                    work_filename = partial_filename
+                    linked = False
+                    if duplicate is not None:
+                        linked = reuse_duplicate(duplicate, filename, work_filename)
+                        if linked:
+                            work_filename = filename
+                        if not linked and not RAW_AUDIO_AS_IS:
+                            set_stage("tag", track_id_str)
+                            if USE_MUTAGEN:
+                                set_audio_tags_mutagen(work_filename, artists, name, album_name,
+                                               release_year, disc_number, track_number, track_id_str, image_url)
+                                if ALBUM_LOUDNESS is not None:
+                                    ALBUM_LOUDNESS.append((work_filename, None, None, duration_ms))
+                            else:
+                                set_audio_tags(work_filename, artists, name, album_name,
+                                               release_year, disc_number, track_number, track_id_str)
+                                set_music_thumbnail(work_filename, image_url)
+                    else:
+                        set_stage("download", track_id_str)
+                        stream = SESSION.content_feeder().load_track(
+                            track, VorbisOnlyAudioQuality(QUALITY), False, None)
+                        # print("###   DOWNLOADING RAW AUDIO   ###")
+
+                        #if not os.path.isdir(ROOT_PATH + extra_paths):
+                        os.makedirs(os.path.dirname(work_filename),exist_ok=True)
+
+                        total_size = stream.input_stream.size
+                        downloaded = 0
+                        _CHUNK_SIZE = get_tuned('chunk_size')
+                        fail = 0
+                        start = time.time()
+                        reserve_bytes(scraped_song_id, int(total_size * (1 + CONVERSION_HEADROOM)), STAGING_PATH or ROOT_PATH)
+                        with open(work_filename, 'wb') as file:
+                            while downloaded <= total_size:
+                                data = stream.input_stream.stream().read(_CHUNK_SIZE)
+
+                                downloaded += len(data)
+                                item_progress(file.write(data))
+                                #print(f"[{total_size}][{_CHUNK_SIZE}] [{len(data)}] [{total_size - downloaded}] [{downloaded}]")
+                                if (total_size - downloaded) < _CHUNK_SIZE:
+                                    _CHUNK_SIZE = total_size - downloaded
+                                if len(data) == 0 : 
+                                    fail += 1                                
+                                if fail > REINTENT_DOWNLOAD:
+                                    break
+                        observe_track(downloaded, time.time() - start)
+
+                        if not RAW_AUDIO_AS_IS:
+                            set_stage("convert", track_id_str)
+                            loudness, peak = convert_audio_format(work_filename)
+                            set_stage("tag", track_id_str)
+                            if USE_MUTAGEN:
+                                set_audio_tags_mutagen(work_filename, artists, name, album_name,
+                                               release_year, disc_number, track_number, track_id_str, image_url, loudness, peak)
+                                if ALBUM_LOUDNESS is not None and loudness is not None:
+                                    ALBUM_LOUDNESS.append((work_filename, loudness, peak, duration_ms))
+                            else:
+                                set_audio_tags(work_filename, artists, name, album_name,
+                                               release_year, disc_number, track_number, track_id_str)
+                                set_music_thumbnail(work_filename, image_url)
+
+                    release_bytes(scraped_song_id)
+                    bitrate = get_bitrate() if duplicate is None else get_tier(read_quality(work_filename)[0])
+                    set_stage("wait", track_id_str)
+                    if duplicate is None and not OVERRIDE_AUTO_WAIT:
+                        time.sleep(get_tuned('wait'))
+
+                    set_stage("archive", track_id_str)
+                    remember_recording(filename, file_id, isrc, bitrate)
+                    if STAGING_PATH and not linked:
+                        STAGED.append({'staged': work_filename, 'filename': filename, 'id': scraped_song_id,
+                                       'artist': artists[0], 'name': name, 'duration_ms': duration_ms,
+                                       'file_id': file_id, 'isrc': isrc, 'bitrate': bitrate})
+                        if len(STAGED) >= STAGING_BATCH_SIZE and ALBUM_LOUDNESS is None:
+                            flush_staging()
+                    else:
+                        if work_filename != filename:
+                            os.replace(work_filename, filename)
+                        add_to_archive(scraped_song_id, os.path.basename(filename), artists[0], name, bitrate)
+                        update_library_index(filename, type='track', id=scraped_song_id, duration_ms=duration_ms,
+                                             file_id=file_id, isrc=isrc, bitrate=bitrate)
+                        release_track(scraped_song_id)
+                    item_finished("item-done", scraped_song_id, song_name,
+                                  f"same recording as {os.path.basename(duplicate)}" if duplicate is not None else "")
+                    set_stage("idle")
         except Exception as e1:
-            print("###   SKIPPING:", song_name, "(GENERAL DOWNLOAD ERROR)   ###", e1)
-            if os.path.exists(filename):
-                os.remove(filename)
+            item_finished("retry", scraped_song_id, song_name, f"general download error: {e1}")
+            observe_stream_failure()
+            if os.path.exists(partial_filename) and (not MULTI_NODE or scraped_song_id in LEASES) \
+                    and not is_staged(None, filename):
+                os.remove(partial_filename)
+            release_track(scraped_song_id)
+            release_bytes(scraped_song_id)
+            if isinstance(e1, OSError) and e1.errno == errno.ENOSPC:
+                # retrying right away would only fail again, wait until something frees space
+                wait_for_disk_space(STAGING_PATH or ROOT_PATH)
             print(f" download_track GENERAL DOWNLOAD ERROR: [{track_id_str}][{extra_paths}][{prefix}][{prefix_value}][{disable_progressbar}]")
-            download_track(track_id_str, extra_paths,prefix=prefix, prefix_value=prefix_value, disable_progressbar=disable_progressbar)
+            download_track(track_id_str, extra_paths,prefix=prefix, prefix_value=prefix_value, disable_progressbar=disable_progressbar,
+                           replace_file=replace_file)
 
 
 def download_album(album):
     """ Downloads songs from an album """
+    global ALBUM_LOUDNESS
     token = SESSION.tokens().get("user-read-email")
-    artist, album_release_date, album_name, total_tracks = get_album_name(token, album)
-    tracks = get_album_tracks(token, album)
-    print(f"\n  {artist} - ({album_release_date}) {album_name} [{total_tracks}]")
-    disc_number_flag = False
-    for track in tracks:
-        if track['disc_number'] > 1:
-            disc_number_flag = True
-    if disc_number_flag: 
-        for n, track in tqdm(enumerate(tracks, start=1), unit_scale=True, unit='Song', total=len(tracks)):
-            disc_number = str(track['disc_number']).zfill(2)
-            download_track(track['id'], os.path.join(artist, f"{artist} - {album_release_date} - {album_name}", f"CD {disc_number}"),prefix=True, prefix_value=str(n), disable_progressbar=True)
-    else: 
-        for n, track in tqdm(enumerate(tracks, start=1), unit_scale=True, unit='Song', total=len(tracks)):
-            download_track(track['id'], os.path.join(artist, f"{artist} - {album_release_date} - {album_name}"),prefix=True, prefix_value=str(n), disable_progressbar=True)
+    artist, album_release_date, album_name, total_tracks = prefetched(get_album_name, token, album)
+    tracks = prefetched(get_album_tracks, token, album)
+    album_paths = get_album_extra_paths(artist, album_release_date, album_name, tracks)
+    ALBUM_LOUDNESS = []
+    start_job("album", f"{artist} - ({album_release_date}) {album_name}", len(tracks))
+    for n, track in enumerate(tracks, start=1):
+        download_track(track['id'], album_paths[n - 1], prefix=True, prefix_value=str(n), disable_progressbar=True)
+    if USE_MUTAGEN and MUSIC_FORMAT == "mp3" and not RAW_AUDIO_AS_IS and ALBUM_LOUDNESS:
+        try:
+            set_album_gain(ALBUM_LOUDNESS)
+        except Exception as e:
+            print("###   FAILED TO SET ALBUM GAIN   ###", e)
+    ALBUM_LOUDNESS = None
+    flush_staging()
+    end_job()
+
+
+def get_album_extra_paths(artist, album_release_date, album_name, tracks):
+    """ Returns the folder of every album track, adding a CD subfolder when the album has several discs """
+    album_path = os.path.join(artist, f"{artist} - {album_release_date} - {album_name}")
+    if any(track['disc_number'] > 1 for track in tracks):
+        return [os.path.join(album_path, f"CD {str(track['disc_number']).zfill(2)}") for track in tracks]
+    return [album_path for track in tracks]
 
 def download_artist_albums(artist):
     """ Downloads albums of an artist """
@@ -912,7 +2026,7 @@ def get_albums_artist(access_token, artists_id):
     headers = {'Authorization': f'Bearer {access_token}'}
     params = {'limit': limit, 'include_groups': include_groups, 'offset': offset}
 
-    resp = requests.get(
+    resp = api_get(
         f'https://api.spotify.com/v1/artists/{artists_id}/albums', headers=headers, params=params).json()
     #print("###   Album Name:", resp['items'], "###")
     return resp['items']
@@ -924,11 +2038,12 @@ def download_playlist(playlists, playlist_choice):
     playlist_songs = get_playlist_songs(
         token, playlists[int(playlist_choice) - 1]['id'])
 
+    start_job("playlist", playlists[int(playlist_choice) - 1]['name'].strip(), len(playlist_songs))
     for song in playlist_songs:
         if song['track']['id'] is not None:
             download_track(song['track']['id'], sanitize_data(
                 playlists[int(playlist_choice) - 1]['name'].strip()) + "/")
-        print("\n")
+    end_job()
 
 def download_playlist_by_id(playlist_id, playlist_name):
     """Downloads all the songs from a playlist using playlist id"""
@@ -936,10 +2051,11 @@ def download_playlist_by_id(playlist_id, playlist_name):
 
     playlist_songs = get_playlist_songs(token, playlist_id)
 
+    start_job("playlist", playlist_name.strip(), len(playlist_songs))
     for song in playlist_songs:
         if song['track']['id'] is not None:
             download_track(song['track']['id'], sanitize_data(playlist_name.strip()) + "/")
-        print("\n")
+    end_job()
 
 def download_from_user_playlist():
     """ Select which playlist(s) to download """
@@ -971,6 +2087,247 @@ def download_from_user_playlist():
         print("\n**All playlists have been downloaded**\n")
 
 
+# Functions related to planning a download job without streaming any audio
+def get_tracks_info(access_token, track_ids):
+    """ Returns track objects for a list of track ids, 50 ids per request """
+    tracks = []
+    limit = 50
+
+    for offset in range(0, len(track_ids), limit):
+        headers = {'Authorization': f'Bearer {access_token}'}
+        params = {'ids': ','.join(track_ids[offset:offset + limit]), 'market': 'from_token'}
+        resp = api_get('https://api.spotify.com/v1/tracks',
+                            headers=headers, params=params).json()
+        tracks.extend(resp['tracks'])
+
+    return tracks
+
+
+def plan_track(track, extra_paths, archive, prefix=False, album_name=None):
+    """ Returns what download_track would do with a track, using listing data only """
+    if track is None or track['id'] is None or not track['name']:
+        return {'type': 'track', 'id': None, 'name': None, 'filename': None,
+                'duration_ms': 0, 'status': 'unavailable', 'reason': 'not on spotify'}
+
+    if album_name is None:
+        album_name = sanitize_data(track['album']['name'])
+    song_name, filename = get_song_filename(sanitize_data(track['artists'][0]['name']), album_name,
+                                            sanitize_data(track['name']), track['track_number'], extra_paths, prefix)
+    item = {'type': 'track', 'id': track['id'], 'name': song_name, 'filename': filename,
+            'duration_ms': track['duration_ms'], 'status': 'new', 'reason': None}
+
+    if not track.get('is_playable', True):
+        item['status'], item['reason'] = 'unavailable', 'not playable'
+    elif is_existing_file(filename) and SKIP_EXISTING_FILES:
+        item['status'], item['reason'] = 'skipped', 'already exists'
+    elif track['id'] in archive and SKIP_PREVIOUSLY_DOWNLOADED:
+        item['status'], item['reason'] = 'skipped', 'already downloaded once'
+    return item
+
+
+def plan_album(access_token, album_id, archive):
+    """ Returns the plan entries of an album """
+    artist, album_release_date, album_name, total_tracks = get_album_name(access_token, album_id)
+    tracks = get_album_tracks(access_token, album_id)
+    album_paths = get_album_extra_paths(artist, album_release_date, album_name, tracks)
+    return [plan_track(track, album_paths[n], archive, prefix=True, album_name=album_name)
+            for n, track in enumerate(tracks)]
+
+
+def plan_episode(episode, podcast_name):
+    """ Returns what download_episode would do with an episode """
+    filename = get_episode_filename(podcast_name, sanitize_data(episode['name']))
+    item = {'type': 'episode', 'id': episode['id'], 'name': os.path.basename(filename), 'filename': filename,
+            'duration_ms': episode['duration_ms'], 'status': 'new', 'reason': None}
+
+    if not episode.get('is_playable', True):
+        item['status'], item['reason'] = 'unavailable', 'not playable'
+    elif is_existing_file(filename) and SKIP_EXISTING_FILES:
+        item['status'], item['reason'] = 'skipped', 'already exists'
+    return item
+
+
+def plan_download(search_input, as_json=False):
+    """ Resolves an url (or liked songs) into the work a download would do and prints its estimated cost """
+    token = SESSION.tokens().get("user-read-email")
+    archive = set(get_previously_downloaded())
+
+    if search_input == "-ls" or search_input == "--liked-songs":
+        token_for_saved = SESSION.tokens().get("user-library-read")
+        items = [plan_track(song['track'], "Liked Songs/", archive) for song in get_saved_tracks(token_for_saved)]
+    else:
+        track_id_str, album_id_str, playlist_id_str, episode_id_str, show_id_str, artist_id_str = regex_input_for_urls(
+            search_input)
+
+        if track_id_str is not None:
+            items = [plan_track(track, "", archive) for track in get_tracks_info(token, [track_id_str])]
+        elif artist_id_str is not None:
+            items = []
+            for album_id in get_artist_albums(token, artist_id_str):
+                items.extend(plan_album(token, album_id, archive))
+        elif album_id_str is not None:
+            items = plan_album(token, album_id_str, archive)
+        elif playlist_id_str is not None:
+            name, creator = get_playlist_info(token, playlist_id_str)
+            items = [plan_track(song['track'], sanitize_data(name) + "/", archive)
+                     for song in get_playlist_songs(token, playlist_id_str)]
+        elif episode_id_str is not None:
+            episode = api_get(f'https://api.spotify.com/v1/episodes/{episode_id_str}?market=from_token',
+                                   headers={'Authorization': f'Bearer {token}'}).json()
+            items = [plan_episode(episode, sanitize_data(episode['show']['name']))]
+        elif show_id_str is not None:
+            podcast_name = get_show_name(token, show_id_str)
+            items = [plan_episode(episode, podcast_name) for episode in get_show_episode_items(token, show_id_str)]
+        else:
+            print("###   PLAN: INPUT IS NOT A SPOTIFY URL   ###")
+            return
+
+    new_items = [item for item in items if item['status'] == 'new']
+    bitrate = get_bitrate()
+    duration_ms = sum(item['duration_ms'] for item in new_items)
+    new_tracks = len([item for item in new_items if item['type'] == 'track'])
+    plan = {
+        'input': search_input,
+        'bitrate_kbps': bitrate,
+        'new': len(new_items),
+        'skipped': len([item for item in items if item['status'] == 'skipped']),
+        'unavailable': len([item for item in items if item['status'] == 'unavailable']),
+        'estimated_bytes': duration_ms * bitrate // 8,
+        'duration_ms': duration_ms,
+        'wait_seconds': 0 if OVERRIDE_AUTO_WAIT else new_tracks * ANTI_BAN_WAIT_TIME,
+        'items': items,
+    }
+
+    if as_json:
+        print(json.dumps(plan), file=OUTPUT, flush=True)
+    else:
+        for item in items:
+            if item['status'] != 'new':
+                print(f"###   {item['status'].upper()}: {item['name'] or item['id']} ({item['reason']})   ###")
+        print(f"\n###   PLAN: {plan['new']} NEW | {plan['skipped']} SKIPPED | {plan['unavailable']} UNAVAILABLE   ###")
+        print(f"Estimated size: {tqdm.format_sizeof(plan['estimated_bytes'], 'B', 1024)} at {bitrate} kbps")
+        print(f"Audio duration: {datetime.timedelta(seconds=duration_ms // 1000)}")
+        print(f"Anti-ban waits: {datetime.timedelta(seconds=plan['wait_seconds'])}")
+
+
+# Functions related to verifying the downloaded library
+def get_library_files():
+    """ Returns the path, modification time and size of every audio file in the library """
+    files = []
+    for root_path in (ROOT_PATH, ROOT_PODCAST_PATH):
+        for dirpath, dirnames, filenames in os.walk(root_path):
+            for filename in filenames:
+                if filename.lower().endswith(AUDIO_EXTENSIONS):
+                    path = os.path.join(dirpath, filename)
+                    stat = os.stat(path)
+                    files.append((path, stat.st_mtime, stat.st_size))
+    return files
+
+
+def open_audio(path):
+    """ Opens a library file with mutagen. Episodes and RAW_AUDIO_AS_IS tracks are ogg vorbis saved with a .wav
+    name, which mutagen.File would try to read as WAVE """
+    if path.lower().endswith('.wav'):
+        try:
+            return OggVorbis(path)
+        except mutagen.MutagenError:
+            pass
+    return mutagen.File(path)
+
+
+def verify_file(path):
+    """ Reads the headers, tags, duration and checksum of a library file, runs in the verify process pool """
+    result = {'path': path, 'length': None, 'id': None, 'checksum': None, 'error': None}
+
+    try:
+        # mutagen takes the duration from the stream itself (frame count of the Xing header, last ogg granule)
+        # so a truncated download is reported with its real, shorter, length
+        audio = open_audio(path)
+        if audio is None:
+            result['error'] = 'unknown audio header'
+        else:
+            result['length'] = audio.info.length
+            if path.lower().endswith('.mp3') and not RAW_AUDIO_AS_IS:
+                comments = audio.tags.getall('COMM') if audio.tags is not None else []
+                track_id = re.search(r'spotify\.com:track:([0-9a-zA-Z]{22})', str(comments[0])) if comments else None
+                if audio.tags is None or 'TIT2' not in audio.tags or track_id is None:
+                    result['error'] = 'missing tags'
+                else:
+                    result['id'] = track_id.group(1)
+    except mutagen.MutagenError as e:
+        result['error'] = f'invalid audio: {e}'
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+    result['checksum'] = sha1.hexdigest()
+
+    return result
+
+
+def verify_library(repair=True):
+    """ Checks every new or modified file of the library and downloads the broken ones again """
+    token = SESSION.tokens().get("user-read-email")
+    index = load_library_index()
+    files = get_library_files()
+
+    changed = [path for path, mtime, size in files
+               if index.get(path, {}).get('verified_mtime') != mtime or index.get(path, {}).get('size') != size]
+    print(f"###   VERIFYING {len(changed)} OF {len(files)} FILES   ###")
+
+    with ProcessPoolExecutor() as pool:
+        for result in tqdm(pool.map(verify_file, changed, chunksize=16), total=len(changed), unit='File'):
+            entry = index.setdefault(result['path'], {'path': result['path']})
+            if result['id'] is not None and entry.get('id') is None:
+                entry['type'], entry['id'] = 'track', result['id']
+            entry.update(length=result['length'], checksum=result['checksum'], error=result['error'], status=None)
+
+    missing_durations = list({entry['id'] for entry in index.values()
+                              if entry.get('type') == 'track' and entry.get('id') and entry.get('duration_ms') is None})
+    durations = {track['id']: track['duration_ms'] for track in get_tracks_info(token, missing_durations) if track}
+
+    existing = {path: (mtime, size) for path, mtime, size in files}
+    broken = []
+    for path in list(index):
+        entry = index[path]
+        if path not in existing:
+            del index[path]
+            continue
+        if entry.get('duration_ms') is None and entry.get('id') in durations:
+            entry['duration_ms'] = durations[entry['id']]
+        if entry.get('status') is None:
+            if entry.get('error') is None and entry.get('duration_ms') is not None \
+                    and abs(entry['length'] - entry['duration_ms'] / 1000) > VERIFY_TOLERANCE:
+                entry['error'] = f"duration {entry['length']:.0f}s, expected {entry['duration_ms'] // 1000}s"
+            entry['status'] = 'broken' if entry.get('error') else 'ok'
+            entry['verified_mtime'], entry['size'] = existing[path]
+        if entry['status'] == 'broken':
+            broken.append(entry)
+            print(f"###   BROKEN: {path} ({entry['error']})   ###")
+
+    save_library_index(index)
+    print(f"###   {len(broken)} BROKEN FILE(S)   ###")
+
+    if repair:
+        # a single archive rewrite, every track is added back once its replacement is in place
+        remove_from_archive({entry['id'] for entry in broken if entry.get('type') != 'episode' and entry.get('id')})
+        for entry in broken:
+            repair_file(entry)
+
+
+def repair_file(entry):
+    """ Downloads a broken library file again, the broken file is only replaced once the new one is complete """
+    if entry.get('id') is None:
+        print(f"###   CANNOT REPAIR: {entry['path']} (UNKNOWN SPOTIFY ID)   ###")
+        return
+
+    if entry.get('type') == 'episode':
+        download_episode(entry['id'], replace_file=entry['path'])
+    else:
+        download_track(entry['id'], replace_file=entry['path'])
+
+
 # Core functions here
 
 def check_raw():
@@ -981,9 +2338,20 @@ def check_raw():
 
 def main():
     """ Main function """
+    if "--profile" in sys.argv:
+        sys.argv.remove("--profile")
+        run_profiled(main)
+        return
+    if "--json" in sys.argv or PROGRESS_MODE == "json":
+        sys.stdout = sys.stderr
     check_raw()
     login()
-    client()
+    try:
+        client()
+        download_claimed_tracks()
+    finally:
+        flush_staging()
+        end_job()
 
 
 if __name__ == "__main__":